@@ -3,15 +3,25 @@ import json
 import random
 import re
 import argparse
+import asyncio
 import logging
-from time import sleep
+import time
+from collections import OrderedDict, deque
 from typing import List, Dict
 from datasets import load_dataset
-from openai import OpenAI, OpenAIError
-from tqdm import tqdm
+from openai import AsyncOpenAI, OpenAIError
+from tqdm.asyncio import tqdm
 import spacy
 from dotenv import load_dotenv
 import hashlib
+import sqlite3
+from datasketch import MinHash, MinHashLSH
+
+# orjson is much faster for the JSONL reads/writes; fall back to the stdlib if it is not installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Initialize logging
 logging.basicConfig(
@@ -24,14 +34,21 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Load spaCy's English model for NER
+# Load spaCy's English model for NER; only entities are used, so skip the tagging and parsing pipes
+SPACY_DISABLED_PIPES = ["tagger", "parser", "attribute_ruler", "lemmatizer"]
 try:
-    nlp = spacy.load("en_core_web_sm")
+    nlp = spacy.load("en_core_web_sm", disable=SPACY_DISABLED_PIPES)
 except OSError:
     logger.info("spaCy model not found. Downloading 'en_core_web_sm'...")
     import subprocess
     subprocess.run(["python", "-m", "spacy", "download", "en_core_web_sm"])
-    nlp = spacy.load("en_core_web_sm")
+    nlp = spacy.load("en_core_web_sm", disable=SPACY_DISABLED_PIPES)
+
+# In en_core_web_sm 3.x ner embeds its own tok2vec and only tagger/parser listen to the shared one,
+# so with those disabled the shared tok2vec does work nobody reads; drop it when no enabled pipe listens.
+if "tok2vec" in nlp.pipe_names and not set(nlp.get_pipe("tok2vec").listening_components) & set(nlp.pipe_names):
+    nlp.disable_pipe("tok2vec")
+    logger.info("Disabled spaCy 'tok2vec': no enabled component listens to it.")
 
 load_dotenv('.env.local')
 
@@ -40,153 +57,454 @@ openai_api_key = os.getenv('OPENAI_KEY')
 if not openai_api_key:
     logger.error("OPENAI_API_KEY environment variable not set.")
     exit(1)
-client = OpenAI(api_key=openai_api_key)
+client = AsyncOpenAI(api_key=openai_api_key)
+
+# spaCy entity labels to anonymize and their placeholders
+ENTITY_REPLACEMENTS = {
+    "GPE": "LOCATION",
+    "LOC": "LOCATION",
+    "TIME": "TIME",
+    "DATE": "DATE",
+    "CARDINAL": "NUMBER",
+    "ORDINAL": "NUMBER",
+    "MONEY": "AMOUNT",
+    "PERSON": "PERSON",
+    "ORG": "ORGANIZATION"
+}
+
+# LRU cache of anonymizations keyed on the raw utterance; least recently used entries are evicted past the size limit
+ANONYMIZE_CACHE_SIZE = 100_000
+_anonymized_cache: "OrderedDict[str, str]" = OrderedDict()
+
+# Minimum number of uncached texts before anonymize_texts starts spaCy worker processes
+MULTIPROCESS_MIN_TEXTS = 2000
+
+def json_loads(data):
+    """
+    Parses JSON with orjson when available, otherwise the stdlib json module.
+    """
+    return orjson.loads(data) if orjson else json.loads(data)
 
-def anonymize_text(text: str) -> str:
+def json_dumps(obj) -> str:
     """
-    Anonymize specific entities in the text such as locations, times, and numbers.
+    Serializes to a single-line JSON string, keeping non-ASCII characters as-is.
     """
-    doc = nlp(text)
-    anonymized_text = text
-    # Define entity replacements
-    replacements = {
-        "GPE": "LOCATION",
-        "LOC": "LOCATION",
-        "TIME": "TIME",
-        "DATE": "DATE",
-        "CARDINAL": "NUMBER",
-        "ORDINAL": "NUMBER",
-        "MONEY": "AMOUNT",
-        "PERSON": "PERSON",
-        "ORG": "ORGANIZATION"
-    }
+    return orjson.dumps(obj).decode('utf-8') if orjson else json.dumps(obj, ensure_ascii=False)
 
-    # Sort entities by start index in reverse to avoid offset issues during replacement
-    entities = sorted(doc.ents, key=lambda ent: ent.start_char, reverse=True)
+# Speaker label patterns for generated dialogues
+_SPEAKER_RE = re.compile(r'^(User|Assistant):', re.MULTILINE)
+_PREFIX_MAP = {'user': 'USER', 'assistant': 'ASSISTANT', 'system': 'ASSISTANT', 'agent': 'ASSISTANT'}
 
+# Separates the dialogues of a multi-dialogue completion
+DIALOGUE_MARKER = "=====DIALOGUE {}====="
+_DIALOGUE_MARKER_RE = re.compile(r'^\s*=====DIALOGUE (\d+)=====\s*$', re.MULTILINE)
+
+def anonymize_doc(doc) -> str:
+    """
+    Anonymize specific entities in an already-parsed spaCy doc such as locations, times, and numbers.
+    """
+    text = doc.text
+    entities = sorted((ent for ent in doc.ents if ent.label_ in ENTITY_REPLACEMENTS), key=lambda ent: ent.start_char)
+
+    # Walk the entities left to right, joining the untouched slices and placeholders once at the end
+    parts = []
+    cursor = 0
     for ent in entities:
-        if ent.label_ in replacements:
-            placeholder = f"<{replacements[ent.label_].upper()}>"
-            anonymized_text = anonymized_text[:ent.start_char] + placeholder + anonymized_text[ent.end_char:]
+        parts.append(text[cursor:ent.start_char])
+        parts.append(f"<{ENTITY_REPLACEMENTS[ent.label_]}>")
+        cursor = ent.end_char
+    parts.append(text[cursor:])
+
+    return "".join(parts)
 
-    return anonymized_text
+def anonymize_text(text: str) -> str:
+    """
+    Anonymize specific entities in the text such as locations, times, and numbers.
+    """
+    return anonymize_texts([text])[0]
+
+def anonymize_texts(texts: List[str], batch_size: int = 64, n_process: int = 1) -> List[str]:
+    """
+    Anonymizes a list of texts, batching them through nlp.pipe to amortize spaCy's per-doc overhead.
+    Results are kept in an LRU cache of at most ANONYMIZE_CACHE_SIZE utterances, so repeated texts
+    ("Thank you", "Goodbye") skip the model entirely.
+    n_process > 1 spreads the batches over worker processes, but only when at least
+    MULTIPROCESS_MIN_TEXTS uncached texts remain.
+    """
+    cached = {}
+    for text in texts:
+        if text in _anonymized_cache and text not in cached:
+            _anonymized_cache.move_to_end(text)
+            cached[text] = _anonymized_cache[text]
+    pending = list(dict.fromkeys(text for text in texts if text not in cached))
+    fresh = {}
+    if pending:
+        # Each worker process loads its own copy of the model, which only pays off for large inputs
+        if len(pending) < MULTIPROCESS_MIN_TEXTS:
+            n_process = 1
+        fresh = {text: anonymize_doc(doc) for text, doc in zip(pending, nlp.pipe(pending, batch_size=batch_size, n_process=n_process))}
+        _anonymized_cache.update(fresh)
+        while len(_anonymized_cache) > ANONYMIZE_CACHE_SIZE:
+            _anonymized_cache.popitem(last=False)
+    return [fresh[text] if text in fresh else cached[text] for text in texts]
 
 def extract_and_anonymize_dialogue(dialogue_json: Dict) -> List[Dict]:
     """
     Extracts turns from the dialogue JSON and anonymizes the utterances.
     Returns a list of turns with anonymized utterances.
     """
-    turns = []
-    speakers = dialogue_json.get("speaker", [])
-    utterances = dialogue_json.get("utterance", [])
-    turn_ids = dialogue_json.get("turn_id", [])
-
-    for turn_id, speaker, utterance in zip(turn_ids, speakers, utterances):
-        if speaker == 0:
-            speaker_label = "USER"
-        elif speaker == 1:
-            speaker_label = "ASSISTANT"
-        else:
-            speaker_label = "UNKNOWN"
+    return extract_and_anonymize_dialogues([dialogue_json])[0]
 
-        anonymized_utterance = anonymize_text(utterance)
+def extract_and_anonymize_dialogues(dialogue_jsons: List[Dict], batch_size: int = 64, n_process: int = 1) -> List[List[Dict]]:
+    """
+    Extracts and anonymizes the turns of several dialogues, sending all of their utterances
+    through spaCy in one batch. Returns one list of turns per input dialogue.
+    """
+    turns_meta = [
+        list(zip(dialogue_json.get("turn_id", []), dialogue_json.get("speaker", []), dialogue_json.get("utterance", [])))
+        for dialogue_json in dialogue_jsons
+    ]
+    anonymized_utterances = iter(anonymize_texts(
+        [utterance for meta in turns_meta for _, _, utterance in meta], batch_size=batch_size, n_process=n_process
+    ))
+
+    all_turns = []
+    for meta in turns_meta:
+        turns = []
+        for (turn_id, speaker, _), anonymized_utterance in zip(meta, anonymized_utterances):
+            if speaker == 0:
+                speaker_label = "USER"
+            elif speaker == 1:
+                speaker_label = "ASSISTANT"
+            else:
+                speaker_label = "UNKNOWN"
 
-        turns.append({
-            "turn_id": turn_id,
-            "speaker": speaker_label,
-            "utterance": anonymized_utterance
-        })
+            turns.append({
+                "turn_id": turn_id,
+                "speaker": speaker_label,
+                "utterance": anonymized_utterance
+            })
+        all_turns.append(turns)
 
-    return turns
+    return all_turns
 
 def generate_base_conversation(turns: List[Dict]) -> str:
     """
     Formats the list of turns into a base conversation string.
     """
-    conversation = ""
-    for turn in turns:
-        conversation += f"{turn['speaker']}: {turn['utterance']}\n"
-    return conversation.strip()
+    return "\n".join(f"{turn['speaker']}: {turn['utterance']}" for turn in turns)
 
-def load_existing_hashes(output_file: str, hash_file: str = 'dialogue_hashes.json') -> set:
+# SQLite database holding the dialogue hashes
+HASH_DB = 'dialogue_hashes.db'
+
+def hash_dialogue(text: str) -> bytes:
     """
-    Loads existing dialogue hashes from a hash file or the output JSON file.
+    Hashes a conversation for duplicate detection. blake2b-128 is faster than SHA-256 and this is not a security use.
+    Returns the raw 16-byte digest; it is only hex-encoded when written to the hash database.
     """
-    if os.path.exists(hash_file):
-        try:
-            with open(hash_file, 'r', encoding='utf-8') as f:
-                hashes = set(json.load(f))
-            logger.info(f"Loaded {len(hashes)} existing dialogue hashes from '{hash_file}'.")
-            return hashes
-        except Exception as e:
-            logger.warning(f"Could not load existing hashes: {e}")
-    elif os.path.exists(output_file):
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest()
+
+# Maps each in-flight batch id to its jobs so a crashed run can be resumed with --resume_batch_id
+PENDING_BATCH_FILE = 'pending_batch.json'
+
+def read_pending_batches(pending_file: str = PENDING_BATCH_FILE) -> Dict[str, List[Dict]]:
+    """
+    Returns every recorded batch id with its jobs, or an empty dict if nothing is pending.
+    """
+    if not os.path.exists(pending_file):
+        return {}
+    with open(pending_file, 'r', encoding='utf-8') as f:
+        return json_loads(f.read())
+
+def write_pending_batches(pending: Dict[str, List[Dict]], pending_file: str = PENDING_BATCH_FILE):
+    """
+    Rewrites the pending batch file, deleting it once no batches are left.
+    """
+    if not pending:
+        if os.path.exists(pending_file):
+            os.remove(pending_file)
+        return
+    temp_file = f"{pending_file}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        f.write(json_dumps(pending))
+    os.replace(temp_file, pending_file)
+
+def save_pending_batch(batch_id: str, jobs: List[Dict], pending_file: str = PENDING_BATCH_FILE):
+    """
+    Records a submitted batch id together with the jobs needed to turn its output into records,
+    alongside any other batches that have not been resumed yet.
+    """
+    pending = read_pending_batches(pending_file)
+    pending[batch_id] = jobs
+    write_pending_batches(pending, pending_file)
+    logger.info(f"Saved pending batch '{batch_id}' to '{pending_file}'. Resume with --resume_batch_id {batch_id} if interrupted.")
+
+def load_pending_batch(batch_id: str, pending_file: str = PENDING_BATCH_FILE):
+    """
+    Returns the jobs saved for batch_id, or None if it is not recorded.
+    """
+    return read_pending_batches(pending_file).get(batch_id)
+
+def remove_pending_batch(batch_id: str, pending_file: str = PENDING_BATCH_FILE):
+    """
+    Forgets a batch whose output has been handled.
+    """
+    pending = read_pending_batches(pending_file)
+    if pending.pop(batch_id, None) is not None:
+        write_pending_batches(pending, pending_file)
+
+# MinHash settings for near-duplicate detection over word shingles
+MINHASH_NUM_PERM = 128
+SHINGLE_SIZE = 5
+
+def dialogue_minhash(conversation: str, num_perm: int = MINHASH_NUM_PERM, shingle_size: int = SHINGLE_SIZE) -> MinHash:
+    """
+    Computes a MinHash signature over the word shingles of a conversation, for near-duplicate detection.
+    """
+    words = conversation.lower().split()
+    shingles = {" ".join(words[i:i + shingle_size]) for i in range(max(1, len(words) - shingle_size + 1))}
+    minhash = MinHash(num_perm=num_perm)
+    # update_batch hashes all shingles in one vectorized call instead of one update() per shingle
+    minhash.update_batch([shingle.encode('utf-8') for shingle in shingles])
+    return minhash
+
+def iter_output_dialogues(output_file: str):
+    """
+    Yields dialogues one at a time from the JSONL output file.
+    """
+    with open(output_file, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json_loads(line)
+
+def migrate_legacy_output(output_file: str) -> bool:
+    """
+    One-time import of output written before the switch to JSONL, when the file held a single JSON array.
+    An array in output_file is rewritten in place as JSONL; if output_file does not exist yet but the
+    matching legacy '.json' file does (e.g. the old default generated_dialogues.json), it is converted
+    into output_file and the legacy file is left untouched. Returns True if anything was converted.
+    """
+    legacy_file = output_file
+    if not os.path.exists(output_file):
+        stem, extension = os.path.splitext(output_file)
+        legacy_file = f"{stem}.json"
+        if extension != '.jsonl' or not os.path.exists(legacy_file):
+            return False
+
+    # Peek at the first non-whitespace character so JSONL files are never read in full here
+    with open(legacy_file, 'r', encoding='utf-8') as f:
+        first_char = ''
+        while True:
+            chunk = f.read(4096)
+            if not chunk:
+                break
+            stripped = chunk.lstrip()
+            if stripped:
+                first_char = stripped[0]
+                break
+        if first_char != '[':
+            return False
+        f.seek(0)
+        dialogues = json_loads(f.read())
+
+    temp_file = f"{output_file}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        f.writelines(json_dumps(dialogue) + "\n" for dialogue in dialogues)
+    os.replace(temp_file, output_file)
+    logger.info(f"Converted {len(dialogues)} dialogues from legacy JSON array '{legacy_file}' to JSONL '{output_file}'.")
+    return True
+
+class HashSet:
+    """
+    Set-like store of dialogue hashes persisted in SQLite. Lookups hit the primary-key index and
+    inserts are committed immediately, so nothing has to be loaded into memory or rewritten per run.
+    Takes raw digests and stores them as hex text.
+    """
+    def __init__(self, db_file: str = HASH_DB):
+        self.conn = sqlite3.connect(db_file)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS dialogue_hashes (hash TEXT PRIMARY KEY)')
+        self.conn.commit()
+
+    def __contains__(self, dialogue_hash: bytes) -> bool:
+        return self.conn.execute(
+            'SELECT 1 FROM dialogue_hashes WHERE hash = ? LIMIT 1', (dialogue_hash.hex(),)
+        ).fetchone() is not None
+
+    def __len__(self) -> int:
+        return self.conn.execute('SELECT COUNT(*) FROM dialogue_hashes').fetchone()[0]
+
+    def add(self, dialogue_hash: bytes):
+        self.conn.execute('INSERT OR IGNORE INTO dialogue_hashes (hash) VALUES (?)', (dialogue_hash.hex(),))
+        self.conn.commit()
+
+    def update(self, dialogue_hashes):
+        self.conn.executemany('INSERT OR IGNORE INTO dialogue_hashes (hash) VALUES (?)', ((h.hex(),) for h in dialogue_hashes))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def load_existing_hashes(output_file: str, hash_db: str = HASH_DB, backfill: bool = False) -> HashSet:
+    """
+    Opens the dialogue hash database, backfilling it from the JSONL output file if it is empty
+    or if backfill is set (e.g. right after importing legacy output).
+    """
+    hashes = HashSet(hash_db)
+    if (backfill or len(hashes) == 0) and os.path.exists(output_file):
         # Fallback to existing output file
         try:
-            with open(output_file, 'r', encoding='utf-8') as f:
-                existing_dialogues = json.load(f)
-                hashes = set()
-                for dialogue in existing_dialogues:
-                    dialogue_text = dialogue.get('base_conversation', '')
-                    dialogue_hash = hashlib.sha256(dialogue_text.encode('utf-8')).hexdigest()
-                    hashes.add(dialogue_hash)
-            logger.info(f"Loaded {len(hashes)} existing dialogue hashes from '{output_file}'.")
-            # Save to hash file for future runs
-            with open(hash_file, 'w', encoding='utf-8') as hf:
-                json.dump(list(hashes), hf, indent=4)
-            return hashes
+            hashes.update(hash_dialogue(dialogue.get('base_conversation', '')) for dialogue in iter_output_dialogues(output_file))
+            logger.info(f"Backfilled '{hash_db}' with hashes from '{output_file}'.")
         except Exception as e:
             logger.warning(f"Could not load existing dialogues: {e}")
-    return set()
+    logger.info(f"Loaded {len(hashes)} existing dialogue hashes from '{hash_db}'.")
+    return hashes
 
-def generate_dialogue(service, prompt, min_turns, max_turns, max_retries=3):
+class RateLimiter:
+    """
+    Sliding-window rate limiter: allows up to max_calls requests in any period-second window.
+    Bursts are admitted until the window is full, after which callers wait for the oldest request to expire.
+    """
+    def __init__(self, max_calls: int, period: float = 60.0):
+        self.max_calls = max_calls
+        self.period = period
+        self.timestamps = deque()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                while self.timestamps and now - self.timestamps[0] >= self.period:
+                    self.timestamps.popleft()
+                if len(self.timestamps) < self.max_calls:
+                    self.timestamps.append(now)
+                    return
+                await asyncio.sleep(self.period - (now - self.timestamps[0]))
+
+# System prompts are kept byte-for-byte identical across requests so OpenAI's prompt caching can reuse
+# the prefix; everything that varies per request (service, turn range, base conversation) goes in the user message.
+SYSTEM_PROMPT = (
+    "You are an expert dialogue generator for customer service. "
+    "Create a high-quality, coherent, and relevant dialogue between a user and an assistant for the service named in the request. "
+    "The dialogue should have the number of turns requested (a turn is one user message and one assistant response). "
+    "The dialogue should not be the same as any existing dialogues and should be better and more engaging.\n\n"
+    "Please format the dialogue as follows, with each user message starting with 'User:' and each assistant response starting with 'Assistant:'.\n"
+    "Example:\n"
+    "User: Hello!\n"
+    "Assistant: Hi there! How can I assist you today?\n"
+)
+
+MULTI_SYSTEM_PROMPT = (
+    "You are an expert dialogue generator. You will be given numbered tasks, each naming the service(s) and a base conversation. "
+    "For every task, create a high-quality, coherent, and relevant dialogue between a user and an assistant. "
+    "Each dialogue should have the number of turns requested (a turn is one user message and one assistant response). "
+    "The dialogues should not be the same as any existing dialogues and should be better and more engaging.\n\n"
+    f"Start each dialogue with a line containing only its marker, e.g. {DIALOGUE_MARKER.format(1)} for task 1, and write nothing outside the dialogues. "
+    "Within a dialogue, start each user message with 'User:' and each assistant response with 'Assistant:'.\n"
+    "Example:\n"
+    f"{DIALOGUE_MARKER.format(1)}\n"
+    "User: Hello!\n"
+    "Assistant: Hi there! How can I assist you today?\n"
+)
+
+# gpt-4o-mini's output token limit; multi-dialogue requests are clamped to it
+MAX_OUTPUT_TOKENS = 16384
+
+def chat_request_body(system_prompt: str, prompt: str, max_tokens: int = 1500) -> Dict:
+    """
+    Wraps a system and user prompt in the chat completions parameters used for every generation.
+    """
+    return {
+        'model': 'gpt-4o-mini',  # Ensure the correct model name is used
+        'messages': [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt}
+        ],
+        'max_tokens': max_tokens,
+        'temperature': 0.9,  # Adjusted temperature for balance between creativity and coherence
+        'top_p': 0.95,
+        'frequency_penalty': 0.5,
+        'presence_penalty': 0.5,
+        'n': 1,  # One completion per request; malformed output is retried instead
+    }
+
+def build_chat_request(service, prompt, min_turns, max_turns) -> Dict:
+    """
+    Builds the chat completions request body shared by the direct API path and the Batch API path.
+    """
+    user_prompt = (
+        f"Service: {service}\n"
+        f"The dialogue should have between {min_turns} and {max_turns} turns.\n\n"
+        f"{prompt}"
+    )
+    return chat_request_body(SYSTEM_PROMPT, user_prompt)
+
+def build_multi_chat_request(jobs: List[Dict], min_turns, max_turns) -> Dict:
+    """
+    Builds one chat completions request that asks for a dialogue per job, each introduced by a
+    DIALOGUE_MARKER line, so the instructions and per-request overhead are shared between them.
+    """
+    tasks = "\n\n".join(f"Task {i}:\n{job['prompt']}" for i, job in enumerate(jobs, start=1))
+    user_prompt = (
+        f"Create {len(jobs)} dialogues, one per task below. "
+        f"Each dialogue should have between {min_turns} and {max_turns} turns.\n\n"
+        f"{tasks}"
+    )
+    return chat_request_body(MULTI_SYSTEM_PROMPT, user_prompt, max_tokens=min(1500 * len(jobs), MAX_OUTPUT_TOKENS))
+
+def select_valid_dialogue(completions: List[str]):
+    """
+    Returns the first completion that contains the expected speaker labels, or None.
+    """
+    for gen_dialogue in completions:
+        # Check if the dialogue contains expected speaker labels
+        if _SPEAKER_RE.search(gen_dialogue):
+            return gen_dialogue
+    return None
+
+def split_multi_dialogue(generated: str, count: int) -> List:
+    """
+    Splits a multi-dialogue completion on its DIALOGUE_MARKER lines.
+    Returns one entry per requested dialogue, None where a section is missing or malformed.
+    """
+    sections = [None] * count
+    parts = _DIALOGUE_MARKER_RE.split(generated)
+    # parts alternates between marker numbers and section bodies after any preamble
+    for number, body in zip(parts[1::2], parts[2::2]):
+        position = int(number) - 1
+        if 0 <= position < count and sections[position] is None:
+            sections[position] = select_valid_dialogue([body.strip()])
+    return sections
+
+async def generate_dialogue(request: Dict, max_retries=3, rate_limiter=None):
     """
     Generates a dialogue using OpenAI's chat completions API with uniqueness checks.
     """
     try:
-        system_prompt = (
-            f"You are an expert dialogue generator for the '{service}' service. "
-            f"Create a high-quality, coherent, and relevant dialogue between a user and an assistant. "
-            f"The dialogue should have between {min_turns} and {max_turns} turns (a turn is one user message and one assistant response). "
-            f"The dialogue should not be the same as any existing dialogues and should be better and more engaging.\n\n"
-            f"Please format the dialogue as follows, with each user message starting with 'User:' and each assistant response starting with 'Assistant:'.\n"
-            f"Example:\n"
-            f"User: Hello!\n"
-            f"Assistant: Hi there! How can I assist you today?\n"
-        )
-
         for attempt in range(1, max_retries + 1):
             try:
-                response = client.chat.completions.create(
-                    model='gpt-4o-mini',  # Ensure the correct model name is used
-                    messages=[
-                        {"role": "system", "content": system_prompt},
-                        {"role": "user", "content": prompt}
-                    ],
-                    max_tokens=1500,
-                    temperature=0.9,  # Adjusted temperature for balance between creativity and coherence
-                    top_p=0.95,
-                    frequency_penalty=0.5,
-                    presence_penalty=0.5,
-                    n=3,  # Generate 3 completions to select from
-                )
+                if rate_limiter:
+                    await rate_limiter.acquire()
+                response = await client.chat.completions.create(**request)
                 generated_dialogues = [choice.message.content.strip() for choice in response.choices]
 
-                for gen_dialogue in generated_dialogues:
-                    # Check if the dialogue contains expected speaker labels
-                    if re.search(r'^(User:|Assistant:)', gen_dialogue, re.MULTILINE):
-                        return gen_dialogue  # Return the first valid formatted dialogue
+                gen_dialogue = select_valid_dialogue(generated_dialogues)
+                if gen_dialogue:
+                    return gen_dialogue  # Return the first valid formatted dialogue
 
                 logger.warning(f"Attempt {attempt} - No valid dialogue found in generated completions.")
                 if attempt < max_retries:
-                    sleep(2 ** attempt)  # Exponential backoff
+                    await asyncio.sleep(2 ** attempt + random.random())  # Exponential backoff with jitter
                 else:
                     logger.error(f"Failed to generate properly formatted dialogue after {max_retries} attempts.")
                     return None
             except OpenAIError as e:
                 logger.warning(f"Attempt {attempt} - OpenAI API error: {e}")
                 if attempt < max_retries:
-                    sleep(2 ** attempt)  # Exponential backoff
+                    await asyncio.sleep(2 ** attempt + random.random())  # Exponential backoff with jitter
                 else:
                     logger.error(f"Failed after {max_retries} attempts.")
                     return None
@@ -194,150 +512,384 @@ def generate_dialogue(service, prompt, min_turns, max_turns, max_retries=3):
         logger.error(f"Unexpected error in generate_dialogue: {e}")
         return None
 
+async def submit_dialogue_batch(requests: Dict[str, Dict]):
+    """
+    Submits chat requests as one OpenAI Batch API job (24-hour window, half the per-token cost).
+    Takes a mapping of custom_id to chat request body and returns the batch id, or None on failure.
+    """
+    if not requests:
+        logger.info("No requests to submit to the Batch API.")
+        return None
+    try:
+        lines = [
+            json_dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body})
+            for custom_id, body in requests.items()
+        ]
+        batch_input = await client.files.create(
+            file=("dialogue_batch.jsonl", "\n".join(lines).encode('utf-8')),
+            purpose="batch"
+        )
+        batch = await client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        logger.info(f"Submitted batch '{batch.id}' with {len(requests)} requests.")
+        return batch.id
+    except OpenAIError as e:
+        logger.error(f"OpenAI Batch API error: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Unexpected error in submit_dialogue_batch: {e}")
+        return None
+
+async def collect_dialogue_batch(batch_id: str, max_poll_interval: float = 300.0):
+    """
+    Waits for a submitted batch to reach a terminal state and returns a mapping of custom_id to the
+    first validly formatted completion. Expired or cancelled batches still yield whatever requests
+    finished. Returns None only if the batch could not be collected, so it is worth resuming later.
+    """
+    try:
+        batch = await client.batches.retrieve(batch_id)
+
+        # Poll with exponential backoff until the batch reaches a terminal state
+        poll_interval = 5.0
+        while batch.status not in ('completed', 'failed', 'expired', 'cancelled'):
+            await asyncio.sleep(poll_interval)
+            poll_interval = min(poll_interval * 2, max_poll_interval)
+            batch = await client.batches.retrieve(batch.id)
+            logger.info(f"Batch '{batch.id}' status: {batch.status}.")
+
+        if batch.status != 'completed':
+            logger.warning(f"Batch '{batch.id}' finished with status '{batch.status}'.")
+        if not batch.output_file_id:
+            logger.error(f"Batch '{batch.id}' has no output file; no requests completed.")
+            return {}
+
+        output = await client.files.content(batch.output_file_id)
+        results = {}
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            result = json_loads(line)
+            response = result.get('response') or {}
+            if result.get('error') or response.get('status_code') != 200:
+                logger.warning(f"Batch request '{result.get('custom_id')}' failed: {result.get('error') or response.get('status_code')}")
+                continue
+            completions = [choice['message']['content'].strip() for choice in response['body']['choices']]
+            gen_dialogue = select_valid_dialogue(completions)
+            if gen_dialogue:
+                results[result['custom_id']] = gen_dialogue
+            else:
+                logger.warning(f"No valid dialogue found in batch completions for '{result['custom_id']}'.")
+        return results
+    except OpenAIError as e:
+        logger.error(f"OpenAI Batch API error: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"Unexpected error in collect_dialogue_batch: {e}")
+        return None
+
 def process_generated_dialogue(generated_dialogue: str) -> List[Dict]:
     """
     Processes the generated dialogue text into a list of turns.
     """
     generated_turns = []
     for line in generated_dialogue.split('\n'):
-        line = line.strip()
-        if line:
-            if line.lower().startswith('user:'):
-                speaker = 'USER'
-                utterance = line.split(':', 1)[1].strip()
-            elif line.lower().startswith(('assistant:', 'system:', 'agent:')):
-                speaker = 'ASSISTANT'
-                utterance = line.split(':', 1)[1].strip()
-            else:
-                continue
+        prefix, separator, utterance = line.strip().partition(':')
+        speaker = _PREFIX_MAP.get(prefix.lower()) if separator else None
+        if speaker:
             generated_turns.append({
                 'speaker': speaker,
-                'utterance': utterance
+                'utterance': utterance.strip()
             })
     return generated_turns
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Generate dialogues using OpenAI API.")
-    parser.add_argument('--num_generations', type=int, required=True, help="Number of dialogues to generate.")
+    parser.add_argument('--num_generations', type=int, help="Number of dialogues to generate (required unless --resume_batch_id is given).")
     parser.add_argument('--min_turns', type=int, default=3, help="Minimum number of dialogue turns.")
     parser.add_argument('--max_turns', type=int, default=10, help="Maximum number of dialogue turns.")
-    parser.add_argument('--output_file', type=str, default='generated_dialogues.json', help="Output JSON file path.")
-    return parser.parse_args()
-
-def main():
+    parser.add_argument('--output_file', type=str, default='generated_dialogues.jsonl', help="Output JSONL file path (one dialogue per line, appended to).")
+    parser.add_argument('--max_concurrency', type=int, default=10, help="Maximum number of in-flight OpenAI requests.")
+    parser.add_argument('--use_batch_api', action='store_true', help="Submit all generations as one OpenAI Batch API job (cheaper, completes within 24h).")
+    parser.add_argument('--resume_batch_id', type=str, help=f"Resume waiting on a Batch API job recorded in '{PENDING_BATCH_FILE}' instead of selecting new dialogues.")
+    parser.add_argument('--dialogues_per_request', type=int, default=1, help="Number of dialogues requested per API call; values above 1 pack several tasks into one prompt to save requests.")
+    parser.add_argument('--n_process', type=int, default=max(1, (os.cpu_count() or 1) - 1), help="Number of processes spaCy uses to anonymize the selected dialogues.")
+    parser.add_argument('--near_duplicate_threshold', type=float, default=0.85, help="Estimated Jaccard similarity above which a generated dialogue is rejected as a near-duplicate.")
+    parser.add_argument('--max_per_second', type=float, default=5.0, help="Average OpenAI requests per second (enforced over a 60-second window).")
+    args = parser.parse_args()
+    if args.max_concurrency < 1:
+        parser.error("--max_concurrency must be at least 1.")
+    if args.max_per_second <= 0:
+        parser.error("--max_per_second must be greater than 0.")
+    if not 0.0 <= args.near_duplicate_threshold <= 1.0:
+        parser.error("--near_duplicate_threshold must be between 0 and 1.")
+    if args.num_generations is None and not args.resume_batch_id:
+        parser.error("--num_generations is required unless --resume_batch_id is given.")
+    return args
+
+async def main():
     args = parse_arguments()
 
     num_generations = args.num_generations
     min_turns = args.min_turns
     max_turns = args.max_turns
     output_file = args.output_file
+    max_concurrency = args.max_concurrency
+    max_per_second = args.max_per_second
+    resume_batch_id = args.resume_batch_id
+    use_batch_api = args.use_batch_api or bool(resume_batch_id)
+    near_duplicate_threshold = args.near_duplicate_threshold
+    dialogues_per_request = max(1, args.dialogues_per_request)
+    n_process = max(1, args.n_process)
 
     logger.info("Starting dialogue generation...")
     logger.info(f"Parameters: num_generations={num_generations}, min_turns={min_turns}, max_turns={max_turns}, output_file='{output_file}'")
+    logger.info(f"Rate limits: max_concurrency={max_concurrency}, max_per_second={max_per_second}, dialogues_per_request={dialogues_per_request}, use_batch_api={use_batch_api}")
 
-    # Load dataset from Hugging Face
     try:
-        dataset = load_dataset('Ayushnangia/transport_multiwoz_v22')
-        data_split = dataset['train']
-        logger.info("Dataset loaded successfully.")
+        migrated = migrate_legacy_output(output_file)
     except Exception as e:
-        logger.error(f"Failed to load dataset: {e}")
+        logger.error(f"Could not convert legacy output for '{output_file}' to JSONL: {e}")
         return
 
-    # Load existing dialogues and their hashes
+    # Load existing dialogue IDs and near-duplicate signatures, streaming the output file line by line
+    existing_ids = set()
+    near_duplicate_index = MinHashLSH(threshold=near_duplicate_threshold, num_perm=MINHASH_NUM_PERM)
     if os.path.exists(output_file):
         try:
-            with open(output_file, 'r', encoding='utf-8') as f:
-                existing_dialogues = json.load(f)
-                existing_ids = {dialogue['dialogue_id'] for dialogue in existing_dialogues}
-            logger.info(f"Loaded {len(existing_dialogues)} existing dialogues from '{output_file}'.")
+            with near_duplicate_index.insertion_session() as session:
+                for dialogue in iter_output_dialogues(output_file):
+                    if dialogue['dialogue_id'] not in existing_ids:
+                        existing_ids.add(dialogue['dialogue_id'])
+                        session.insert(dialogue['dialogue_id'], dialogue_minhash(dialogue.get('base_conversation', '')))
+            logger.info(f"Loaded {len(existing_ids)} existing dialogues from '{output_file}'.")
         except Exception as e:
-            logger.warning(f"Could not load existing dialogues: {e}")
-            existing_dialogues = []
-            existing_ids = set()
-    else:
-        existing_dialogues = []
-        existing_ids = set()
-
-    existing_hashes = load_existing_hashes(output_file, 'dialogue_hashes.json')
+            # Appending to a file we cannot parse would leave it mixed-format, so stop here
+            logger.error(f"Could not load existing dialogues from '{output_file}' (expected JSONL): {e}")
+            return
 
-    # Prepare list to collect new dialogues
-    new_dialogues = []
-
-    # Randomly select examples to generate dialogues for
-    if num_generations > len(data_split):
-        logger.error("Number of generations requested exceeds the dataset size.")
+    try:
+        existing_hashes = load_existing_hashes(output_file, HASH_DB, backfill=migrated)
+    except sqlite3.Error as e:
+        logger.error(f"Failed to open hash database '{HASH_DB}': {e}")
         return
 
-    selected_indices = random.sample(range(len(data_split)), num_generations)
-
-    for index in tqdm(selected_indices, desc="Generating dialogues"):
-        example = data_split[index]
-        services = example.get('services', [])
-        dialogue_id = example.get('dialogue_id', f"dialogue_{index}")
-
-        # Extract and anonymize existing dialogue
-        processed_dialogue = extract_and_anonymize_dialogue(example)
-        base_conversation = generate_base_conversation(processed_dialogue)
-
-        # Create hash of the base conversation to check for duplicates
-        dialogue_hash = hashlib.sha256(base_conversation.encode('utf-8')).hexdigest()
-        if dialogue_hash in existing_hashes:
-            logger.info(f"Duplicate dialogue detected for dialogue_id '{dialogue_id}'. Skipping.")
-            continue
-
-        prompt = (
-            f"Using the following base conversation as a reference, create a new dialogue for the service(s): {', '.join(services)}. "
-            f"The dialogue should be completely new and more relevant than any existing dialogue. Do not copy any part of existing dialogues. "
-            f"The dialogue should be between a user and an assistant.\n\n"
-            f"Base Conversation:\n{base_conversation}"
-        )
-
-        generated_dialogue = generate_dialogue(services[0] if services else "general", prompt, min_turns, max_turns)
-
-        if generated_dialogue:
-            generated_turns = process_generated_dialogue(generated_dialogue)
-            generated_conversation = generate_base_conversation(generated_turns)
-            generated_hash = hashlib.sha256(generated_conversation.encode('utf-8')).hexdigest()
+    # Guards existing_hashes and existing_ids, which are shared by all in-flight generations
+    hashes_lock = asyncio.Lock()
+    # Cap in-flight requests and requests per minute to stay within the account's OpenAI tier limits
+    semaphore = asyncio.Semaphore(max_concurrency)
+    rate_limiter = RateLimiter(max_calls=max(1, int(max_per_second * 60)), period=60.0)
+
+    def prepare_generations(indices):
+        """
+        Anonymizes the selected source dialogues and builds their generation prompts.
+        Duplicates are dropped here, before any API call is spent on them.
+        """
+        # One Arrow-backed select instead of a __getitem__ per row
+        examples = list(data_split.select(indices))
+        # All anonymization happens here, across processes, so the async workers only assemble prompts and call the API
+        processed_dialogues = extract_and_anonymize_dialogues(examples, batch_size=128, n_process=n_process)
+
+        jobs = []
+        seen_hashes = set()
+        for index, example, processed_dialogue in zip(indices, examples, processed_dialogues):
+            services = example.get('services', [])
+            dialogue_id = example.get('dialogue_id', f"dialogue_{index}")
+            new_dialogue_id = f"{dialogue_id}_generated_{index}"
+            base_conversation = generate_base_conversation(processed_dialogue)
 
+            # Create hash of the base conversation to check for duplicates
+            dialogue_hash = hash_dialogue(base_conversation)
+            if dialogue_hash in existing_hashes or dialogue_hash in seen_hashes:
+                logger.info(f"Duplicate dialogue detected for dialogue_id '{dialogue_id}'. Skipping.")
+                continue
+            if new_dialogue_id in existing_ids:
+                logger.info(f"Dialogue_id '{new_dialogue_id}' was already generated. Skipping.")
+                continue
+            seen_hashes.add(dialogue_hash)
+
+            prompt = (
+                f"Using the following base conversation as a reference, create a new dialogue for the service(s): {', '.join(services)}. "
+                f"The dialogue should be completely new and more relevant than any existing dialogue. Do not copy any part of existing dialogues. "
+                f"The dialogue should be between a user and an assistant.\n\n"
+                f"Base Conversation:\n{base_conversation}"
+            )
+            jobs.append({
+                'index': index,
+                'services': services,
+                'dialogue_id': dialogue_id,
+                'new_dialogue_id': new_dialogue_id,
+                'service': services[0] if services else "general",
+                'prompt': prompt
+            })
+        return jobs
+
+    async def finalize_generation(job, generated_dialogue):
+        """
+        Turns a generated dialogue into an output record, or returns None if it is a duplicate.
+        Exact duplicates are caught by hash first; near-duplicates by MinHash LSH, which also sets
+        job['near_duplicate'] so the caller can regenerate.
+        """
+        dialogue_id = job['dialogue_id']
+        new_dialogue_id = job['new_dialogue_id']
+        generated_turns = process_generated_dialogue(generated_dialogue)
+        generated_conversation = generate_base_conversation(generated_turns)
+        generated_hash = hash_dialogue(generated_conversation)
+        generated_minhash = dialogue_minhash(generated_conversation)
+        job['near_duplicate'] = False
+
+        async with hashes_lock:
             if generated_hash in existing_hashes:
                 logger.warning(f"Generated dialogue is a duplicate for dialogue_id '{dialogue_id}'. Skipping.")
-                continue
+                return None
+
+            if near_duplicate_index.query(generated_minhash):
+                logger.warning(f"Generated dialogue is a near-duplicate for dialogue_id '{dialogue_id}'.")
+                job['near_duplicate'] = True
+                return None
 
-            new_dialogue_id = f"{dialogue_id}_generated_{index}"
             if new_dialogue_id in existing_ids:
                 logger.warning(f"Duplicate dialogue_id '{new_dialogue_id}' found. Skipping.")
-                continue
+                return None
 
-            new_dialogues.append({
-                'services': services,
+            record = {
+                'services': job['services'],
                 'dialogue_id': new_dialogue_id,
                 'turns': generated_turns,
                 'base_conversation': generated_conversation
-            })
+            }
+            # Persist immediately so a crash only loses in-flight dialogues
+            out_f.write(json_dumps(record) + "\n")
+            out_f.flush()
+
             existing_ids.add(new_dialogue_id)
             existing_hashes.add(generated_hash)
+            near_duplicate_index.insert(new_dialogue_id, generated_minhash)
+
+        return record
+
+    async def generate_group(group, max_attempts=3):
+        """
+        Generates dialogues for a group of jobs in a single request, re-requesting any that are
+        missing from a multi-dialogue response or turn out to be near-duplicates.
+        """
+        records = []
+        pending = group
+        for attempt in range(1, max_attempts + 1):
+            if len(pending) == 1:
+                request = build_chat_request(pending[0]['service'], pending[0]['prompt'], min_turns, max_turns)
+            else:
+                request = build_multi_chat_request(pending, min_turns, max_turns)
+            async with semaphore:
+                generated_dialogue = await generate_dialogue(request, rate_limiter=rate_limiter)
+            if not generated_dialogue:
+                return records
+
+            sections = [generated_dialogue] if len(pending) == 1 else split_multi_dialogue(generated_dialogue, len(pending))
+            missing = []
+            near_duplicates = []
+            for job, section in zip(pending, sections):
+                if not section:
+                    # Dropped or renumbered markers: request this dialogue again
+                    missing.append(job)
+                    continue
+                record = await finalize_generation(job, section)
+                if record:
+                    records.append(record)
+                elif job['near_duplicate']:
+                    near_duplicates.append(job)
+
+            pending = missing + near_duplicates
+            if not pending:
+                return records
+            logger.info(f"{len(missing)} missing and {len(near_duplicates)} near-duplicate dialogue(s) to regenerate (attempt {attempt}/{max_attempts}).")
+
+        dialogue_ids = ', '.join(f"'{job['dialogue_id']}'" for job in pending)
+        logger.warning(f"No acceptable dialogue generated for dialogue_id(s) {dialogue_ids} after {max_attempts} attempts. Skipping.")
+        return records
+
+    if resume_batch_id:
+        try:
+            jobs = load_pending_batch(resume_batch_id)
+        except Exception as e:
+            logger.error(f"Could not read '{PENDING_BATCH_FILE}': {e}")
+            jobs = None
+        if jobs is None:
+            logger.error(f"No pending batch '{resume_batch_id}' recorded in '{PENDING_BATCH_FILE}'.")
+            existing_hashes.close()
+            return
+        logger.info(f"Resuming batch '{resume_batch_id}' with {len(jobs)} jobs.")
+    else:
+        # Load dataset from Hugging Face
+        try:
+            dataset = load_dataset('Ayushnangia/transport_multiwoz_v22')
+            data_split = dataset['train']
+            logger.info("Dataset loaded successfully.")
+        except Exception as e:
+            logger.error(f"Failed to load dataset: {e}")
+            existing_hashes.close()
+            return
 
-    logger.info("Dialogue generation complete.")
+        # Randomly select examples to generate dialogues for
+        if num_generations > len(data_split):
+            logger.error("Number of generations requested exceeds the dataset size.")
+            existing_hashes.close()
+            return
 
-    # Combine existing and new dialogues
-    all_dialogues = existing_dialogues + new_dialogues
+        selected_indices = random.sample(range(len(data_split)), num_generations)
+        jobs = prepare_generations(selected_indices)
+        logger.info(f"{len(jobs)} of {len(selected_indices)} selected dialogues remain after duplicate filtering.")
 
-    # Save the new dialogues to a JSON file
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(all_dialogues, f, indent=4, ensure_ascii=False)
-        logger.info(f"Generated dialogues saved to '{output_file}'. Total dialogues: {len(all_dialogues)}.")
+        out_f = open(output_file, 'a', encoding='utf-8')
     except Exception as e:
-        logger.error(f"Failed to save dialogues to '{output_file}': {e}")
+        logger.error(f"Failed to open '{output_file}' for appending: {e}")
+        existing_hashes.close()
+        return
 
-    # Update the dialogue hashes
-    try:
-        with open('dialogue_hashes.json', 'w', encoding='utf-8') as hf:
-            json.dump(list(existing_hashes), hf, indent=4)
-        logger.info(f"Updated 'dialogue_hashes.json' with {len(existing_hashes)} hashes.")
-    except Exception as e:
-        logger.error(f"Failed to update 'dialogue_hashes.json': {e}")
+    with out_f:
+        if use_batch_api:
+            if not resume_batch_id:
+                try:
+                    unresumed = list(read_pending_batches())
+                except Exception as e:
+                    logger.warning(f"Could not read '{PENDING_BATCH_FILE}': {e}")
+                    unresumed = []
+                for batch_id in unresumed:
+                    logger.warning(f"Batch '{batch_id}' has not been collected yet; resume it with --resume_batch_id {batch_id}.")
+            batch_id = resume_batch_id or await submit_dialogue_batch({
+                job['new_dialogue_id']: build_chat_request(job['service'], job['prompt'], min_turns, max_turns)
+                for job in jobs
+            })
+            results = []
+            if batch_id:
+                if not resume_batch_id:
+                    try:
+                        save_pending_batch(batch_id, jobs)
+                    except Exception as e:
+                        logger.error(f"Could not record batch '{batch_id}' in '{PENDING_BATCH_FILE}'; it cannot be resumed if this run stops: {e}")
+                generated = await collect_dialogue_batch(batch_id)
+                if generated is None:
+                    logger.warning(f"Batch '{batch_id}' was not collected; resume with --resume_batch_id {batch_id}.")
+                else:
+                    results = [
+                        await finalize_generation(job, generated[job['new_dialogue_id']])
+                        for job in jobs if job['new_dialogue_id'] in generated
+                    ]
+                    # The batch reached a terminal state and its output has been handled
+                    remove_pending_batch(batch_id)
+        else:
+            groups = [jobs[i:i + dialogues_per_request] for i in range(0, len(jobs), dialogues_per_request)]
+            tasks = [generate_group(group) for group in groups]
+            results = [record for records in await tqdm.gather(*tasks, desc="Generating dialogues") for record in records]
+    new_dialogues = [dialogue for dialogue in results if dialogue]
+
+    logger.info("Dialogue generation complete.")
+    logger.info(f"Appended {len(new_dialogues)} new dialogues to '{output_file}'. Total dialogues: {len(existing_ids)}.")
+    logger.info(f"'{HASH_DB}' now holds {len(existing_hashes)} hashes.")
+    existing_hashes.close()
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())